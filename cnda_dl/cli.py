@@ -6,19 +6,29 @@ Authors:
 '''
 from pathlib import Path
 import atexit
+import contextlib
+import errno
+import functools
+import getpass
 import re
 import argparse
 import logging
+import logging.handlers
 import os
+import queue
 import shlex
 import shutil
 import subprocess
 import sys
-import xml.etree.ElementTree as et
 import datetime
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import pyxnat as px
 import progressbar as pb
+from lxml import etree as et
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from .formatters import ParensOnRightFormatter1
 from .zip_utils import unzipped
@@ -30,7 +40,8 @@ logging.basicConfig(level=logging.INFO,
                     handlers=[sout_handler],
                     format=default_log_format)
 
-logger = logging.getLogger()
+# handlers live on the root logger, the package logs under its own name so -v only affects cnda-dl
+logger = logging.getLogger("cnda_dl")
 
 
 def handle_dir_creation(dir_path: Path):
@@ -60,6 +71,23 @@ def handle_dir_creation(dir_path: Path):
             logger.info("Invalid response")
 
 
+def configure_http_session(central: px.Interface):
+    '''
+    Mount a keep-alive connection pool with retries on the requests session pyxnat uses,
+    so consecutive REST calls reuse TCP/TLS connections instead of reconnecting.
+
+    :param central: CNDA connection object
+    :type central: pyxnat.Interface
+    '''
+    # each Interface serves one session at a time, so a small pool per Interface is enough
+    adapter = HTTPAdapter(pool_connections=8,
+                          pool_maxsize=8,
+                          # transient gateway errors are retried too, Retry leaves POST out of this by default
+                          max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[502, 503, 504]))
+    central._http.mount("http://", adapter)
+    central._http.mount("https://", adapter)
+
+
 def download_xml(central: px.Interface,
                  subject_id: str,
                  project_id: str,
@@ -67,8 +95,8 @@ def download_xml(central: px.Interface,
 
     logger.info("Downloading session xml")
     sub = central.select(f"/projects/{project_id}/subjects/{subject_id}")
-    with open(file_path, "w") as f:
-        f.write(sub.get().decode())
+    with open(file_path, "wb") as f:
+        f.write(sub.get())
     return True
 
 
@@ -85,54 +113,109 @@ def retrieve_experiment(central: px.Interface,
     else:
         query_params['subject_label'] = session
 
-    return central.array.mrsessions(**query_params)
+    # ask for the labels as well, so the archive request doesn't have to look them up separately
+    return central.array.mrsessions(columns=["label", "xnat:subjectData/label"], **query_params)
+
+
+SessionXml = namedtuple("SessionXml", ["scan_uids", "scan_types", "resources"])
+
+
+@functools.lru_cache(maxsize=8)
+def _parse_session_xml(xml_file: str, mtime_ns: int) -> SessionXml:
+    # mtime_ns is only part of the cache key, so an overwritten XML is parsed again
+    scan_uids = {}
+    scan_types = set()
+    resources = set()
+    first_scans_read = False
+    for _, elem in et.iterparse(xml_file, tag=("{*}scan", "{*}scans", "{*}resource"), huge_tree=True):
+        tag = et.QName(elem).localname
+        if tag == "scans":
+            # only the scans of the first experiment are mapped to UIDs
+            first_scans_read = True
+        elif tag == "resource":
+            if (label := elem.get("label")) is not None:
+                resources.add(label)
+        elif elem.get("ID") is not None:
+            if (scan_type := elem.get("type")) is not None:
+                scan_types.add(scan_type)
+            # [:-6] is to ignore the trailing '.0.0.0' at the end of the UID string
+            if not first_scans_read and (uid := elem.get("UID")) is not None:
+                scan_uids[uid[:-6]] = elem.get("ID")
+        elem.clear(keep_tail=True)
+    return SessionXml(scan_uids, frozenset(scan_types), frozenset(resources))
+
+
+def read_session_xml(xml_file: Path) -> SessionXml:
+    """
+    Collect the scan UIDs, scan types and resource labels from the session XML in one pass
+
+    The last few results are cached by path and modification time, so the helpers below share a single parse.
+
+    :param xml_file: path to session XML
+    :type xml_file: pathlib.Path
+    """
+    return _parse_session_xml(str(xml_file), xml_file.stat().st_mtime_ns)
 
 
 def get_xml_scans(xml_file: Path) -> dict:
     """
-    Create a map of downloaded scan IDs to UIDs to later match with the UIDs in the .dat files
+    Create a map of scan UIDs to scan IDs to later match with the UIDs in the .dat files
 
     :param xml_file: path to quality XML
     :type xml_file: pathlib.Path
     """
-    xml_tree = et.parse(xml_file)
-    prefix = "{" + str(xml_tree.getroot()).split("{")[-1].split("}")[0] + "}"
-    scan_xml_entries = xml_tree.getroot().find(
-        f"./{prefix}experiments/{prefix}experiment/{prefix}scans"
-    )
-    return scan_xml_entries
+    return dict(read_session_xml(xml_file).scan_uids)
 
 
 def get_scan_types(xml_path):
-    # Get unique scan types to include in POST req
-    with open(xml_path, "r") as f:
-        xml_text = f.read()
-    return list(set(
-        re.findall(
-            r'ID="[\d\w_\-]+"\s+type="([a-zA-Z0-9\-_\.]+)"',
-            xml_text
-        )
-    ))
+    # Get unique scan types to include in POST req, sorted so the request is the same on every run
+    return sorted(read_session_xml(xml_path).scan_types)
 
 
 def get_resources(xml_path):
     # Get "additional resources" that appear on CNDA for the session
     # (usually NORDIC_VOLUMES)
-    with open(xml_path, "r") as f:
-        xml_text = f.read()
-    return list(set(
-        re.findall(
-            r'resource label="([a-zA-Z0-9\-_]+)"',
-            xml_text
-        )
-    ))
+    return sorted(read_session_xml(xml_path).resources)
+
+
+def list_files_by_suffix(directory: Path, suffixes: tuple[str, ...]) -> dict[str, list[Path]]:
+    # Files in directory grouped by which of the suffixes they end in, using a
+    # single os.scandir pass instead of one Path.glob per suffix
+    files = {suffix: [] for suffix in suffixes}
+    with os.scandir(directory) as it:
+        for e in it:
+            suffix = os.path.splitext(e.name)[1]
+            if suffix in files and e.is_file():
+                files[suffix].append(Path(e.path))
+    return files
+
+
+class ProgressWriter:
+    '''
+    Wraps a binary file so every write also advances a progress bar, letting
+    shutil.copyfileobj do the copying while the bar keeps up.
+
+    The bar is redrawn while holding the stdout log handler's lock, so log lines
+    that other threads print above the bar can't interleave with a redraw.
+    '''
+    def __init__(self, f, bar: pb.ProgressBar):
+        self.f = f
+        self.bar = bar
+        self.bytes_written = 0
+
+    def write(self, b) -> int:
+        n = self.f.write(b)
+        self.bytes_written += n
+        with sout_handler.lock:
+            self.bar.update(self.bytes_written)
+        return n
 
 
 def download_experiment_zip(central: px.Interface,
                             exp: px.jsonutil.JsonTable,
                             dicom_dir: Path,
                             xml_file_path: Path,
-                            keep_zip: bool = False):
+                            show_progress: bool = True):
     '''
     Download scan data as .zip from CNDA.
 
@@ -144,27 +227,41 @@ def download_experiment_zip(central: px.Interface,
     :type dicom_dir: pathlib.Path
     :param xml_file_path: Path to experiment XML
     :type xml_file_path: pathlib.Path
-    :param keep_zip: Will not delete downloaded zip file after unzipping
-    :type keep_zip: bool
+    :param show_progress: Display a progress bar while downloading
+    :type show_progress: bool
+    :return: Path to the downloaded .zip file
     '''
-    sub_obj = central.select(f"/project/{exp['project']}/subjects/{exp['xnat:mrsessiondata/subject_id']}")
-    exp_obj = central.select(f"/project/{exp['project']}/subjects/{exp['xnat:mrsessiondata/subject_id']}/experiments/{exp['ID']}")
+    project_id = exp["project"]
+    experiment_id = exp["ID"]
+    subject_uri = f"/project/{project_id}/subjects/{exp['xnat:mrsessiondata/subject_id']}"
+    if exp.has_header("xnat:subjectdata/label"):
+        subject_label = exp["xnat:subjectdata/label"]
+    else:
+        subject_label = central.select(subject_uri).label()
+    if exp.has_header("label"):
+        experiment_label = exp["label"]
+    else:
+        experiment_label = central.select(f"{subject_uri}/experiments/{experiment_id}").label()
     # Step 1: make POST request to prepare .zip download
     res1 = central.post(
         "/xapi/archive/downloadwithsize",
         json={
-            "sessions": [f"{exp['project']}:{sub_obj.label()}:{exp_obj.label()}:{exp['ID']}"],
-            "projectIds": [exp['project']],
+            "sessions": [f"{project_id}:{subject_label}:{experiment_label}:{experiment_id}"],
+            "projectIds": [project_id],
             "scan_formats": ["DICOM"],
             "scan_types": get_scan_types(xml_file_path),
             "resources": get_resources(xml_file_path),
             "options": ["simplified"]
         }
     )
+    download_info = res1.json()
+    download_id = download_info["id"]
     # Step 2: make GET request with created ID from POST
-    cur_bytes, total_bytes = 0, int(res1.json()["size"])
+    total_bytes = int(download_info["size"])
 
     def _build_progress_bar():
+        if not show_progress:
+            return pb.NullBar(max_value=total_bytes)
         widgets = [
             pb.DataSize(), '/', pb.DataSize(variable='max_value'),
             pb.Percentage(),
@@ -175,33 +272,74 @@ def download_experiment_zip(central: px.Interface,
             ' ',
             pb.FileTransferSpeed()
         ]
+        # log lines written meanwhile are printed above the bar, see main
         return pb.ProgressBar(
             max_value=total_bytes,
-            widgets=widgets
+            widgets=widgets,
+            redirect_stdout=True
         )
     logger.info("Downloading session .zip")
-    res2 = central.get(f"/xapi/archive/download/{res1.json()['id']}/zip", timeout=(60, 300))
-    res2.raise_for_status()
-    with (
-        open(zip_path := (dicom_dir / f"{res1.json()['id']}.zip"), "wb") as f,
-        _build_progress_bar() as bar
-    ):
-        logger.info(f"Request headers: {res2.request.headers}")
-        logger.info(f"Response headers: {res2.headers}")
-        logger.removeHandler(sout_handler)
-        for chunk in res2.iter_content(chunk_size=(chunk_size := 1024)):
-            if chunk:
-                f.write(chunk)
-                cur_bytes += chunk_size
-                bar.update(cur_bytes)
-    logger.addHandler(sout_handler)
+    # stream the body straight to disk instead of holding the whole archive in memory
+    with central.get(f"/xapi/archive/download/{download_id}/zip", timeout=(60, 300), stream=True) as res2:
+        res2.raise_for_status()
+        with (
+            open(zip_path := (dicom_dir / f"{download_id}.zip"), "wb", buffering=4 * 1024 * 1024) as f,
+            _build_progress_bar() as bar
+        ):
+            request_headers = {k: v for k, v in res2.request.headers.items() if k.lower() != "authorization"}
+            logger.debug("Request headers: %s", request_headers)
+            logger.debug("Response headers: %s", res2.headers)
+            res2.raw.decode_content = True
+            shutil.copyfileobj(res2.raw, ProgressWriter(f, bar), length=1 << 20)
+            with sout_handler.lock:
+                bar.finish()
     logger.info("Download complete!")
-    top_zip_members = unzipped(zip_path, keep_zip=keep_zip)
+    return zip_path
+
+
+def unzip_experiment_zip(zip_path: Path,
+                         extract_dir: Path,
+                         keep_zip: bool = False) -> Path:
+    '''
+    Extract a session .zip downloaded by download_experiment_zip.
+
+    :param zip_path: Path to the downloaded .zip file
+    :type zip_path: pathlib.Path
+    :param extract_dir: Path to the directory the .zip is extracted into
+    :type extract_dir: pathlib.Path
+    :param keep_zip: Will not delete downloaded zip file after unzipping
+    :type keep_zip: bool
+    :return: Path to the unzipped session directory
+    '''
+    top_zip_members = unzipped(zip_path, keep_zip=keep_zip, extract_dir=extract_dir)
     unzipped_dirs = [d for d in top_zip_members if d.is_dir()]
     if len(unzipped_dirs) > 1:
         logger.warning(f"The zip file contained more than one top-level file/folder. Using the first directory member found: {unzipped_dirs[0]}")
     return unzipped_dirs[0]
-    # recursive_unzip(unzipped_dir, keep_zip=False)  # for NORDIC_VOLUMES already zipped up
+
+
+def run_dcmdat2niix(series_id: str,
+                    series_path: Path,
+                    session_nifti_dir: Path) -> int:
+    """
+    Run dcmdat2niix on a single series, logging its output as it runs
+
+    :param series_id: ID of the series being converted
+    :type series_id: str
+    :param series_path: Path to the series DICOM directory
+    :type series_path: pathlib.Path
+    :param session_nifti_dir: Path to the directory the NIFTI files are written to
+    :type session_nifti_dir: pathlib.Path
+    :return: exit code of dcmdat2niix
+    """
+    logger.info("Running dcmdat2niix on series %s", series_id)
+    dcmdat2niix_cmd = shlex.split(f"dcmdat2niix -ba y -z o -w 1 -o {session_nifti_dir} {series_path}")
+    # stderr is merged into stdout so a single blocking read drains both pipes
+    with subprocess.Popen(dcmdat2niix_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                          text=True, errors="ignore") as p:
+        for line in p.stdout:
+            logger.info("%s: %s", series_id, line.rstrip())
+        return p.wait()
 
 
 def dat_dcm_to_nifti(session: str,
@@ -209,7 +347,8 @@ def dat_dcm_to_nifti(session: str,
                      xml_file_path: Path,
                      session_dicom_dir: Path,
                      session_nifti_dir: Path,
-                     skip_short_runs: bool = False):
+                     skip_short_runs: bool = False,
+                     jobs: int = 1):
     """
     Pair .dcm/.dat files with dcmdat2niix
 
@@ -225,10 +364,13 @@ def dat_dcm_to_nifti(session: str,
     :type session_nifti_dir: pathlib.Path
     :param skip_short_runs: Flag which denotes we don't want to run dcmdat2niix on runs stopped short
     :type skip_short_runs: bool
+    :param jobs: Number of dcmdat2niix conversions to run at the same time
+    :type jobs: int
     """
     can_convert = False
     unconverted_series = set()
     error_series = set()
+    series_to_convert = []
     if shutil.which('dcmdat2niix') is not None:
         can_convert = True
         session_nifti_dir.mkdir(parents=True, exist_ok=True)
@@ -237,30 +379,46 @@ def dat_dcm_to_nifti(session: str,
         logger.warning("dcmdat2niix not installed or has not been added to the PATH. Cannot convert data files into NIFTI")
 
     # find all of the scans that are in the dicom directory for this session
-    downloaded_scans = [p.name.split("/")[-1] for p in session_dicom_dir.glob("*")
-                        if (p / "DICOM").exists()]
-    downloaded_scans.sort()
+    with os.scandir(session_dicom_dir) as it:
+        downloaded_scans = sorted(e.name for e in it
+                                  if e.is_dir() and os.path.isdir(os.path.join(e.path, "DICOM")))
 
     xml_scans = get_xml_scans(xml_file=xml_file_path)
-    # [:-6] is to ignore the trailing '.0.0.0' at the end of the UID string
-    uid_to_id = {s.get("UID")[:-6]:s.get("ID") for s in xml_scans if s.get("ID") in downloaded_scans}
+    uid_to_id = {uid: scan_id for uid, scan_id in xml_scans.items() if scan_id in downloaded_scans}
 
     # collect all of the .dat files and map them to their UIDs
-    dat_files = list(dat_directory.rglob("*.dat"))
-    uid_to_dats = {uid: [d for d in dat_files if uid in d.name] for uid in uid_to_id.keys()}
+    dat_files = [(root, name) for root, _, files in os.walk(dat_directory) for name in files if name.endswith(".dat")]
+    uid_to_dats = {uid: [] for uid in uid_to_id}
+    if uid_to_id:
+        # longest UIDs first, so a UID that is a prefix of another one can't shadow it
+        uid_pattern = re.compile("|".join(re.escape(uid) for uid in sorted(uid_to_id, key=len, reverse=True)))
+        for root, name in dat_files:
+            if (match := uid_pattern.search(name)) is not None:
+                uid_to_dats[match.group(0)].append(Path(root, name))
 
     for uid, dats in uid_to_dats.items():
         series_id = uid_to_id[uid]
         series_path = session_dicom_dir / series_id / "DICOM"
+        resolved_series_path = series_path.resolve()
         for dat in dats:
-            shutil.move(dat.resolve(), series_path.resolve())
+            if dat.is_symlink():
+                # move the linked file itself, a relative link would break in the series directory
+                dat = dat.resolve()
+            # a plain rename when both sides are on the same filesystem, copy otherwise
+            try:
+                os.replace(dat, resolved_series_path / dat.name)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.move(dat, resolved_series_path)
 
+        series_files = list_files_by_suffix(series_path, (".dat", ".dcm"))
         if len(dats) == 0:
-            dats = list(series_path.glob("*.dat"))  # see if dats already in series dir
+            dats = series_files[".dat"]  # see if dats already in series dir
 
-        dcms = list(series_path.glob("*.dcm"))
-        logger.info(f"length of dats: {len(dats)}")
-        logger.info(f"length of dcms: {len(dcms)}")
+        dcms = series_files[".dcm"]
+        logger.debug("length of dats: %d", len(dats))
+        logger.debug("length of dcms: %d", len(dcms))
 
         # if we cannot convert to NIFTI then continue
         if not can_convert:
@@ -276,22 +434,24 @@ def dat_dcm_to_nifti(session: str,
                 continue
             elif (len(dcms) == len(dats) + 1) and len(dcms) > 1:
                 logger.info("Attempting to remove the extra dcm file, and convert the remaining data")
-                last_dcm = list(series_path.glob(f"*-{len(dcms)}-*.dcm"))
+                last_dcm_pattern = re.compile(rf".*-{len(dcms)}-.*\.dcm")
+                last_dcm = [d for d in dcms if last_dcm_pattern.fullmatch(d.name)]
                 if len(last_dcm) == 1:
                     logger.info(f"Removing the mismatched dicom: {last_dcm[0]}")
                     os.remove(last_dcm[0])
                 else:
                     logger.warning("Could not find the mismatched dicom")
 
-        # run the dcmdat2niix subprocess
-        logger.info(f"Running dcmdat2niix on series {series_id}")
-        dcmdat2niix_cmd = shlex.split(f"dcmdat2niix -ba y -z o -w 1 -o {session_nifti_dir} {series_path}")
-        with subprocess.Popen(dcmdat2niix_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as p:
-            while p.poll() is None:
-                for line in p.stdout:
-                    logger.info(line.decode("utf-8", "ignore"))
-            if p.poll() == 0:
-                logger.info(f"dcmdat2niix complete for series {series_id} \n")
+        series_to_convert.append((series_id, series_path))
+
+    # run the dcmdat2niix subprocesses, each series is converted independently
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(run_dcmdat2niix, series_id, series_path, session_nifti_dir): series_id
+                   for series_id, series_path in series_to_convert}
+        for future in as_completed(futures):
+            series_id = futures[future]
+            if future.result() == 0:
+                logger.info("dcmdat2niix complete for series %s \n", series_id)
             else:
                 logger.error(f"dcmdat2niix ended with a nonzero exit code for series {series_id} \n")
                 error_series.add(series_id)
@@ -313,6 +473,148 @@ def dat_dcm_to_nifti(session: str,
         {sorted(error_series)}\n""")
 
 
+@contextlib.contextmanager
+def borrow_connection(connections: queue.Queue):
+    '''
+    Take a CNDA connection from the queue and put it back once the caller is done with it.
+
+    :param connections: queue of pyxnat.Interface objects
+    :type connections: queue.Queue
+    '''
+    central = connections.get()
+    try:
+        yield central
+    finally:
+        connections.put(central)
+
+
+def process_session(session: str,
+                    args: argparse.Namespace,
+                    connections: queue.Queue,
+                    dicom_dir: Path,
+                    xml_path: Path,
+                    show_progress: bool = True) -> bool:
+    '''
+    Download and convert a single session, as requested by the command-line arguments.
+
+    :param session: subject label or experiment id of the session
+    :type session: str
+    :param args: parsed command-line arguments
+    :type args: argparse.Namespace
+    :param connections: queue of CNDA connections, one is borrowed while the session downloads
+    :type connections: queue.Queue
+    :param dicom_dir: Path to the directory the dicom files are downloaded to
+    :type dicom_dir: pathlib.Path
+    :param xml_path: Path to the directory the session xml file is downloaded to
+    :type xml_path: pathlib.Path
+    :param show_progress: Display a progress bar while the session .zip downloads
+    :type show_progress: bool
+    :return: True if every step for the session succeeded
+    '''
+    xml_file_path = xml_path / f"{session}.xml"
+    session_dicom_dir = dicom_dir / session
+    session_nifti_dir = dicom_dir / f"{session}_nii"
+    # if only mapping is needed
+    if args.map_dats:
+        # map the .dat files to the correct scans and convert the files to NIFTI
+        try:
+            dat_dcm_to_nifti(session=session,
+                             dat_directory=args.map_dats,
+                             xml_file_path=xml_file_path,
+                             session_dicom_dir=session_dicom_dir,
+                             session_nifti_dir=session_nifti_dir,
+                             skip_short_runs=args.skip_short_runs,
+                             jobs=args.dcmdat2niix_jobs)
+        except Exception:
+            logger.exception(f"Error moving the .dat files to the appropriate scan directories and converting to NIFTI for session: {session}")
+            return False
+        return True
+
+    zip_path = None
+    with borrow_connection(connections) as central:
+        # download the experiment data
+        logger.info(f"Starting download of session {session}")
+
+        # try to retrieve the experiment corresponding to this session
+        exp = None
+        try:
+            exp = retrieve_experiment(central=central,
+                                      session=session,
+                                      experiment_id=args.experiment_id,
+                                      project_id=args.project_id)
+            if len(exp) == 0:
+                raise RuntimeError("ERROR: CNDA query returned JsonTable object of length 0, meaning there were no results found with the given search parameters.")
+            elif len(exp) > 1:
+                raise RuntimeError("ERROR: CNDA query returned JsonTable object of length >1, meaning there were multiple results returned with the given search parameters.")
+
+        except Exception:
+            logger.exception("Error retrieving the experiment from the given parameters. Double check your inputs or enter more specific parameters.")
+            return False
+
+        download_xml(central=central,
+                     subject_id=exp["xnat:mrsessiondata/subject_id"],
+                     project_id=exp["project"],
+                     file_path=xml_file_path)
+        if args.xml_only:
+            return True
+        if args.skip_existing and session_dicom_dir.is_dir():
+            logger.info(f"{session_dicom_dir} already exists, skipping the download of session {session}")
+        elif not args.dats_only:
+            try:
+                zip_path = download_experiment_zip(central=central,
+                                                   exp=exp,
+                                                   dicom_dir=dicom_dir,
+                                                   xml_file_path=xml_file_path,
+                                                   show_progress=show_progress)
+            except Exception as e:
+                logger.exception(f"Error downloading the experiment data from CNDA for session: {session}")
+                logger.exception(f"{e=}")
+                return False
+
+    # the connection is already back in the queue, so the next session can download while this one is unzipped
+    if zip_path is not None:
+        # extract into a staging directory and only move the session into place once it is complete,
+        # so --skip_existing never mistakes an interrupted extraction for a finished download
+        staging_dir = dicom_dir / f".{session}.partial"
+        try:
+            if staging_dir.exists():
+                shutil.rmtree(staging_dir)  # left behind by an interrupted run
+            staging_dir.mkdir()
+            unzip_session_dicom_dir = unzip_experiment_zip(zip_path,
+                                                           extract_dir=staging_dir,
+                                                           keep_zip=args.keep_zip)
+            try:
+                os.rename(unzip_session_dicom_dir, session_dicom_dir)
+            except OSError as e:
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+                # keep the existing directory, this download goes next to it instead
+                fallback_dir = dicom_dir / f"{session}_{zip_path.stem}"
+                logger.warning(f"could not rename {unzip_session_dicom_dir.name} to {session_dicom_dir} because the directory already exists, using {fallback_dir}")
+                os.rename(unzip_session_dicom_dir, fallback_dir)
+                session_dicom_dir = fallback_dir
+            # any other top-level members go where they were extracted to before
+            for leftover in staging_dir.iterdir():
+                os.replace(leftover, dicom_dir / leftover.name)
+            staging_dir.rmdir()
+        except Exception as e:
+            logger.exception(f"Error unzipping the experiment data for session: {session}")
+            logger.exception(f"{e=}")
+            return False
+
+    nordic_dat_dir = session_dicom_dir / "NORDIC_VOLUMES"
+    if args.skip_dcmdat2niix or not nordic_dat_dir.is_dir():
+        return True
+    dat_dcm_to_nifti(session=session,
+                     dat_directory=nordic_dat_dir,
+                     xml_file_path=xml_file_path,
+                     session_dicom_dir=session_dicom_dir,
+                     session_nifti_dir=session_nifti_dir,
+                     skip_short_runs=args.skip_short_runs,
+                     jobs=args.dcmdat2niix_jobs)
+    return True
+
+
 def main():
     parser = argparse.ArgumentParser(
         prog="cnda-dl",
@@ -343,15 +645,27 @@ def main():
     parser.add_argument("--skip_short_runs",
                         action="store_true",
                         help="Flag to indicate that runs stopped short should not be converted to NIFTI")
+    parser.add_argument("--dcmdat2niix_jobs", type=int,
+                        default=min(4, os.cpu_count() or 1),
+                        help="Number of series to convert with dcmdat2niix at the same time (default: %(default)s)")
     parser.add_argument("--dats_only",
                         help="Skip downloading DICOMs, only try to pull .dat files",
                         action='store_true')
     parser.add_argument("--keep_zip",
                         help="Option to keep downloaded .zip file after unzipping",
                         action='store_true')
+    parser.add_argument("--skip_existing",
+                        help="""Don't download sessions that already have a DICOM directory in --dicom_dir (e.g. from an
+                        earlier, interrupted run). The xml is still refreshed and dcmdat2niix still runs on them""",
+                        action='store_true')
     parser.add_argument("--xml_only", "-xo",
                         action="store_true",
                         help="Flag to indicate that only the xml file should be downloaded.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of sessions to download and convert at the same time (default: %(default)s)")
+    parser.add_argument("-v", "--verbose",
+                        action="store_true",
+                        help="Also log debug messages, such as HTTP headers and per-series file counts")
     args = parser.parse_args()
 
     # validate argument inputs
@@ -366,11 +680,30 @@ def main():
     if args.map_dats and not args.map_dats.is_dir():
         parser.error(f"'--map_dats' directory does not exist: {args.map_dats}")
 
-    # set up file logging
+    if args.dcmdat2niix_jobs < 1:
+        parser.error("'--dcmdat2niix_jobs' must be at least 1")
+
+    if args.jobs < 1:
+        parser.error("'--jobs' must be at least 1")
+
+    # set up file logging, records are written by a background thread so the
+    # download and conversion threads never block on the log file
     file_handler = logging.FileHandler(log_path)
     file_handler.setFormatter(logging.Formatter(default_log_format))
-    logger.addHandler(file_handler)
-    logger.addHandler(sout_handler)
+    log_queue = queue.Queue(-1)
+    queue_listener = logging.handlers.QueueListener(log_queue, file_handler)
+    queue_listener.start()
+    atexit.register(queue_listener.stop)
+    root_logger = logging.getLogger()
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    # while a progress bar is drawn, progressbar2 holds stdout writes back and prints them above the bar,
+    # so the other worker's log lines still reach the terminal during a download
+    sout_handler.setStream(pb.streams.wrap_stdout())
+    sout_handler.formatter.watch_terminal_resize()
+    root_logger.addHandler(sout_handler)
+    if args.verbose:
+        # third-party loggers (urllib3, requests) stay at INFO
+        logger.setLevel(logging.DEBUG)
 
     logger.info("Starting cnda-dl")
     logger.info(f"Log will be stored at {log_path}")
@@ -388,86 +721,38 @@ def main():
     if not xml_path.is_dir():
         handle_dir_creation(xml_path)
 
-    # set up CNDA connection
-    central = None
+    # set up CNDA connections, one per parallel download so workers never share a requests session
+    connections = queue.Queue()
     if not args.map_dats:
-        central = px.Interface(server="https://cnda.wustl.edu/")
-        atexit.register(central.disconnect)
-
-    # main loop
-    for session in session_list:
-        download_success = False
-        xml_file_path = xml_path / f"{session}.xml"
-        session_dicom_dir = dicom_dir / session
-        session_nifti_dir = dicom_dir / f"{session}_nii"
-        # if only mapping is needed
-        if args.map_dats:
-            # map the .dat files to the correct scans and convert the files to NIFTI
+        # ask for the credentials once (with the same prompts pyxnat uses) and log every connection in with them
+        user = input("User: ")
+        password = getpass.getpass()
+        for _ in range(args.jobs):
+            connection = px.Interface(server="https://cnda.wustl.edu/", user=user, password=password)
+            configure_http_session(connection)
+            atexit.register(connection.disconnect)
+            connections.put(connection)
+
+    # main loop, sessions are independent so several can be processed at once. Only args.jobs of them
+    # hold a connection at a time, the extra worker unzips and converts a finished download meanwhile
+    download_success = True
+    show_progress = args.jobs == 1
+    max_workers = args.jobs if args.map_dats else args.jobs + 1
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(process_session,
+                                   session=session,
+                                   args=args,
+                                   connections=connections,
+                                   dicom_dir=dicom_dir,
+                                   xml_path=xml_path,
+                                   show_progress=show_progress): session
+                   for session in session_list}
+        for future in as_completed(futures):
             try:
-                dat_dcm_to_nifti(session=session,
-                                 dat_directory=args.map_dats,
-                                 xml_file_path=xml_file_path,
-                                 session_dicom_dir=session_dicom_dir,
-                                 session_nifti_dir=session_nifti_dir,
-                                 skip_short_runs=args.skip_short_runs)
+                download_success = future.result() and download_success
             except Exception:
-                logger.exception(f"Error moving the .dat files to the appropriate scan directories and converting to NIFTI for session: {session}")
-                download_success = False
-            continue
-
-        # download the experiment data
-        logger.info(f"Starting download of session {session}")
-
-        # try to retrieve the experiment corresponding to this session
-        exp = None
-        try:
-            exp = retrieve_experiment(central=central,
-                                      session=session,
-                                      experiment_id=args.experiment_id,
-                                      project_id=args.project_id)
-            if len(exp) == 0:
-                raise RuntimeError("ERROR: CNDA query returned JsonTable object of length 0, meaning there were no results found with the given search parameters.")
-            elif len(exp) > 1:
-                raise RuntimeError("ERROR: CNDA query returned JsonTable object of length >1, meaning there were multiple results returned with the given search parameters.")
-
-        except Exception:
-            logger.exception("Error retrieving the experiment from the given parameters. Double check your inputs or enter more specific parameters.")
-            download_success = False
-            continue
-
-        download_xml(central=central,
-                     subject_id=exp["xnat:mrsessiondata/subject_id"],
-                     project_id=exp["project"],
-                     file_path=xml_file_path)
-        if args.xml_only:
-            continue
-        if not args.dats_only:
-            try:
-                unzip_session_dicom_dir = download_experiment_zip(central=central,
-                                        exp=exp,
-                                        dicom_dir=dicom_dir,
-                                        xml_file_path=xml_file_path,
-                                        keep_zip=args.keep_zip)
-                if unzip_session_dicom_dir.name != session_dicom_dir.name:
-                    os.rename(unzip_session_dicom_dir.resolve(), session_dicom_dir.resolve())
-            except FileExistsError:
-                logger.warning(f"could not rename {unzip_session_dicom_dir} to {session_dicom_dir} because the directory already exists")
-                session_dicom_dir = unzip_session_dicom_dir
-            except Exception as e:
-                logger.exception(f"Error downloading the experiment data from CNDA for session: {session}")
-                logger.exception(f"{e=}")
+                logger.exception(f"Unexpected error while processing session: {futures[future]}")
                 download_success = False
-                continue
-
-        nordic_dat_dir = session_dicom_dir / "NORDIC_VOLUMES"
-        if args.skip_dcmdat2niix or not nordic_dat_dir.is_dir():
-            continue
-        dat_dcm_to_nifti(session=session,
-                         dat_directory=nordic_dat_dir,
-                         xml_file_path=xml_file_path,
-                         session_dicom_dir=session_dicom_dir,
-                         session_nifti_dir=session_nifti_dir,
-                         skip_short_runs=args.skip_short_runs)
     if download_success:
         logger.info("\nDownloads Complete")
 
@@ -1,5 +1,8 @@
 import logging
-import os
+import shutil
+import signal
+import sys
+import threading
 
 
 class Colors:
@@ -43,23 +46,48 @@ class Colors:
     BACK_LIGHT_WHITE = "\033[107m"
 
 
+# colour of the right margin text for each level
+LEVEL_COLOR = {
+    "INFO": Colors.LIGHT_GREEN,
+    "WARNING": Colors.YELLOW,
+    "ERROR": Colors.RED,
+    "DEBUG": Colors.DARK_GREY,
+}
+PADDING_DOT = f"{Colors.DARK_GREY}.{Colors.RESET}"
+
+
 class ParensOnRightFormatter1(logging.Formatter):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._update_terminal_width()
+
+    def watch_terminal_resize(self):
+        # refresh the cached width when the terminal is resized. Meant to be called from the main
+        # thread of the program (signal handlers can't be installed elsewhere), only when stdout is a
+        # terminal, and a handler the process already has is left alone
+        if (hasattr(signal, "SIGWINCH")
+                and threading.current_thread() is threading.main_thread()
+                and sys.__stdout__ is not None and sys.__stdout__.isatty()
+                and signal.getsignal(signal.SIGWINCH) == signal.SIG_DFL):
+            signal.signal(signal.SIGWINCH, lambda signum, frame: self._update_terminal_width())
+
+    def _update_terminal_width(self):
+        # falls back to 120 columns when stdout is not a terminal (e.g. redirected to a file)
+        self.terminal_width = shutil.get_terminal_size((120, 24)).columns
+
     def format(self, record):
-        log_message = f"{record.msg}"
-        log_level = f"{record.levelname}"
-        func_name = (f"{record.funcName}")
-        if func_name[-1] == '.':
-            func_name[-1] = f"{Colors.DARK_GREY}.{Colors.RESET}"
-        # Determine total width of terminal window
-        terminal_width = os.get_terminal_size()[0]
+        log_message = record.getMessage()
+        log_level = record.levelname
+        func_name = record.funcName
+        # measure the margin before any colour codes are added, they take up no columns on screen
+        visible_margin_len = len(f"({log_level}, {func_name})")
+        if func_name.endswith('.'):
+            func_name = func_name[:-1] + PADDING_DOT
         # Calculate the right margin position for the log level and function name
-        if log_level == "INFO":
-            right_margin_text = f"{Colors.LIGHT_GREEN}({log_level}, {func_name}){Colors.RESET}"
-        elif log_level == "WARNING":
-            right_margin_text = f"{Colors.YELLOW}({log_level}, {func_name}){Colors.RESET}"
-        elif log_level == "ERROR":
-            right_margin_text = f"{Colors.RED}({log_level}, {func_name}){Colors.RESET}"
-        necessary_padding = terminal_width - len(log_message) - len(right_margin_text)
+        right_margin_text = f"({log_level}, {func_name})"
+        if (color := LEVEL_COLOR.get(log_level)) is not None:
+            right_margin_text = f"{color}{right_margin_text}{Colors.RESET}"
+        necessary_padding = self.terminal_width - len(log_message) - visible_margin_len
         # Ensure padding is non-negative
-        padding = f'{Colors.DARK_GREY}.{Colors.RESET}' * max(0, necessary_padding)
+        padding = PADDING_DOT * max(0, necessary_padding)
         return f"{log_message}{padding}{right_margin_text}"
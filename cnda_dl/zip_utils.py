@@ -1,30 +1,63 @@
+import os
 import zipfile
-from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
 import logging
 
-logger = logging.getLogger()
+logger = logging.getLogger("cnda_dl")
 
 
-def unzipped(zip_path: str | Path, keep_zip: bool = False, recursive: bool = True):
-    zip_members = None
-    if isinstance(zip_path, str):
-        zip_path = Path(zip_path)
+def _extract_batch(zip_path: Path, members: list[zipfile.ZipInfo], dest: Path):
+    # each worker reads through its own ZipFile handle, a single handle is not safe to share
     with zipfile.ZipFile(zip_path, "r") as zip_ref:
-        zip_members = zip_ref.namelist()
-        logger.info(f"Unzipping {zip_path}...")
-        zip_ref.extractall(zip_path.parent)
+        for member in members:
+            zip_ref.extract(member, dest)
+
+
+def _extract_members(zip_path: Path, infos: list[zipfile.ZipInfo], dest: Path, jobs: int):
+    # create the directory tree up front so the workers never race on makedirs
+    for info in infos:
+        parts = [p for p in PurePosixPath(info.filename).parts if p not in ("/", "..")]
+        target = dest.joinpath(*parts)
+        (target if info.is_dir() else target.parent).mkdir(parents=True, exist_ok=True)
+    files = [info for info in infos if not info.is_dir()]
+    batches = [batch for batch in (files[i::jobs] for i in range(jobs)) if batch]
+    with ThreadPoolExecutor(max_workers=max(1, len(batches))) as executor:
+        for future in [executor.submit(_extract_batch, zip_path, batch, dest) for batch in batches]:
+            future.result()
+
+
+def _unzip_one(zip_path: Path, keep_zip: bool, jobs: int, dest: Path) -> list[str]:
+    # extract a single archive into dest and return the names of its members
+    with zipfile.ZipFile(zip_path, "r") as zip_ref:
+        zip_infos = zip_ref.infolist()
+    logger.info("Unzipping %s...", zip_path)
+    _extract_members(zip_path, zip_infos, dest, jobs)
     if not keep_zip:
-        logger.info(f"Removing {zip_path}...")
+        logger.info("Removing %s...", zip_path)
         zip_path.unlink()
+    return [info.filename for info in zip_infos]
+
+
+def unzipped(zip_path: str | Path,
+             keep_zip: bool = False,
+             recursive: bool = True,
+             jobs: int = min(8, os.cpu_count() or 1),
+             extract_dir: str | Path | None = None):
+    if isinstance(zip_path, str):
+        zip_path = Path(zip_path)
+    # the top-level archive goes to extract_dir if given, nested ones are always extracted next to themselves
+    extract_dir = zip_path.parent if extract_dir is None else Path(extract_dir)
+    zip_members = _unzip_one(zip_path, keep_zip, jobs, extract_dir)
     if not zip_members:
         logger.warning("The zip file is empty, did not find a top level file/folder")
-    top_members = set([Path(zm).parents[-2] for zm in zip_members])
+    top_members = set([Path(zm).parts[0] for zm in zip_members])
     if recursive:
-        for zm in zip_members:
-            full_zm = zip_path.parent / zm
-            if full_zm.suffix == ".zip":
-                unzipped(full_zm)
-            elif full_zm.is_dir():
-                for sub_zip in full_zm.rglob("*.zip"):
-                    unzipped(sub_zip)
-    return [zip_path.parent / tm for tm in top_members]
+        # member lists already name every nested file, so inner zips are found without walking the tree
+        pending = deque(extract_dir / zm for zm in zip_members if zm.endswith(".zip"))
+        while pending:
+            inner_zip = pending.popleft()
+            inner_members = _unzip_one(inner_zip, False, jobs, inner_zip.parent)
+            pending.extend(inner_zip.parent / zm for zm in inner_members if zm.endswith(".zip"))
+    return [extract_dir / tm for tm in top_members]